@@ -4,12 +4,28 @@ Common utilities for nanochat.
 
 import os
 import re
+import sys
 import logging
 import fcntl
+import shutil
+import functools
 import urllib.request
 import json
-import torch
-import torch.distributed as dist
+
+# Note: torch is deliberately NOT imported at module level. Scripts like the
+# data checker only need get_base_dir() and shouldn't pay ~1-2s of torch
+# startup; the compute functions below import it at call time instead.
+
+try:
+    import tomllib  # Python 3.11+ stdlib, C-accelerated
+except ImportError:
+    import tomli as tomllib  # backport for Python 3.10
+
+# Repo root and config file locations, computed once instead of per call
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_PYPROJECT_PATH = os.path.join(_PROJECT_ROOT, "pyproject.toml")
+_CONFIG_TOML_PATH = os.path.join(_PROJECT_ROOT, "config", "nanochat.toml")
+_CONFIG_JSON_PATH = os.path.join(_PROJECT_ROOT, "config", "nanochat.json")
 
 class ColoredFormatter(logging.Formatter):
     """Custom formatter that adds colors to log messages."""
@@ -23,7 +39,24 @@ class ColoredFormatter(logging.Formatter):
     }
     RESET = '\033[0m'
     BOLD = '\033[1m'
+    # Precompiled patterns and replacement strings, so format() only pays the
+    # C-level Pattern.sub cost per log record
+    NUM_UNIT_RE = re.compile(r'(\d+\.?\d*\s*(?:GB|MB|%|docs))')
+    NUM_UNIT_SUB = rf'{BOLD}\1{RESET}'
+    SHARD_RE = re.compile(r'(Shard \d+)')
+    SHARD_SUB = rf'{COLORS["INFO"]}{BOLD}\1{RESET}'
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Only emit ANSI escapes when we're actually talking to a terminal
+        # (honors the de facto NO_COLOR standard, keeps CI/file logs clean)
+        self._use_color = (
+            hasattr(sys.stderr, 'isatty') and sys.stderr.isatty()
+            and os.environ.get('NO_COLOR') is None
+            and os.environ.get('TERM') != 'dumb'
+        )
     def format(self, record):
+        if not self._use_color:
+            return super().format(record)
         # Add color to the level name
         levelname = record.levelname
         if levelname in self.COLORS:
@@ -33,11 +66,14 @@ class ColoredFormatter(logging.Formatter):
         # Add color to specific parts of the message
         if levelname == 'INFO':
             # Highlight numbers and percentages
-            message = re.sub(r'(\d+\.?\d*\s*(?:GB|MB|%|docs))', rf'{self.BOLD}\1{self.RESET}', message)
-            message = re.sub(r'(Shard \d+)', rf'{self.COLORS["INFO"]}{self.BOLD}\1{self.RESET}', message)
+            message = self.NUM_UNIT_RE.sub(self.NUM_UNIT_SUB, message)
+            message = self.SHARD_RE.sub(self.SHARD_SUB, message)
         return message
 
 def setup_default_logging():
+    # Deliberately not invoked at import time: configuring the root logger is a
+    # side effect importers may not want, and basicConfig is a no-op anyway once
+    # the caller has installed its own handlers
     handler = logging.StreamHandler()
     handler.setFormatter(ColoredFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
     logging.basicConfig(
@@ -45,47 +81,52 @@ def setup_default_logging():
         handlers=[handler]
     )
 
-setup_default_logging()
 logger = logging.getLogger(__name__)
 
+def _load_pyproject(path):
+    with open(path, 'rb') as f:
+        pyproject_config = tomllib.load(f)
+    nanochat_config = pyproject_config.get("tool", {}).get("nanochat", {})
+    # An empty [tool.nanochat] falls through to the next candidate
+    return {"paths": nanochat_config} if nanochat_config else None
+
+def _load_toml(path):
+    with open(path, 'rb') as f:
+        return tomllib.load(f)
+
+def _load_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# Candidate config files, in priority order (json kept for backward compatibility)
+_CONFIG_CANDIDATES = [
+    (_PYPROJECT_PATH, _load_pyproject),
+    (_CONFIG_TOML_PATH, _load_toml),
+    (_CONFIG_JSON_PATH, _load_json),
+]
+
+@functools.lru_cache(maxsize=1)
 def load_config():
-    """Load configuration from pyproject.toml or config/nanochat.toml if they exist."""
-    import toml
-
-    # Try to load from pyproject.toml first
-    pyproject_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "pyproject.toml")
-    if os.path.exists(pyproject_path):
-        try:
-            with open(pyproject_path, 'r') as f:
-                pyproject_config = toml.load(f)
-            nanochat_config = pyproject_config.get("tool", {}).get("nanochat", {})
-            if nanochat_config:
-                return {"paths": nanochat_config}
-        except Exception as e:
-            logger.warning(f"Failed to load pyproject.toml config: {e}")
+    """Load configuration from pyproject.toml or config/nanochat.toml if they exist.
 
-    # Fallback to config/nanochat.toml
-    config_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config", "nanochat.toml")
-    if os.path.exists(config_path):
+    The result is cached: the config files don't change within a process, and
+    this gets called from every data check and download, so parse them once."""
+    for path, loader in _CONFIG_CANDIDATES:
         try:
-            with open(config_path, 'r') as f:
-                return toml.load(f)
+            config = loader(path)
+        except FileNotFoundError:
+            continue  # EAFP: one failed open instead of a stat + open per candidate
         except Exception as e:
-            logger.warning(f"Failed to load config file {config_path}: {e}")
-
-    # Fallback to old json format for backward compatibility
-    config_json_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config", "nanochat.json")
-    if os.path.exists(config_json_path):
-        try:
-            with open(config_json_path, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.warning(f"Failed to load config file {config_json_path}: {e}")
-
+            logger.warning(f"Failed to load config file {path}: {e}")
+            continue
+        if config is not None:
+            return config
     return {}
 
+@functools.lru_cache(maxsize=1)
 def get_base_dir():
     # Priority order: environment variable > config file > default
+    # Deterministic within a process, so cache it (also skips the repeated makedirs)
     if os.environ.get("NANOCHAT_BASE_DIR"):
         nanochat_dir = os.environ.get("NANOCHAT_BASE_DIR")
     else:
@@ -101,35 +142,93 @@ def get_base_dir():
     os.makedirs(nanochat_dir, exist_ok=True)
     return nanochat_dir
 
+# Byte-range parallelism: several TCP streams beat single-stream congestion
+# control on fat pipes to S3. Only kicks in for servers that advertise ranges
+# and for payloads big enough to amortize the extra connections.
+_RANGE_STREAMS = 4
+_RANGE_MIN_SIZE = 8 * 1024 * 1024
+
+def _download_range(url, fd, start, end):
+    request = urllib.request.Request(url, headers={'Range': f'bytes={start}-{end}'})
+    offset = start
+    with urllib.request.urlopen(request) as response:
+        while True:
+            chunk = response.read(1024 * 1024)
+            if not chunk:
+                break
+            os.pwrite(fd, chunk, offset)  # positional write, no per-thread seek
+            offset += len(chunk)
+
+def _download_url_ranges(url, tmp_path, size):
+    from concurrent.futures import ThreadPoolExecutor
+    chunk_size = size // _RANGE_STREAMS
+    bounds = [(i * chunk_size, size - 1 if i == _RANGE_STREAMS - 1 else (i + 1) * chunk_size - 1)
+              for i in range(_RANGE_STREAMS)]
+    fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.truncate(fd, size)
+        with ThreadPoolExecutor(max_workers=_RANGE_STREAMS) as executor:
+            futures = [executor.submit(_download_range, url, fd, a, b) for a, b in bounds]
+            for future in futures:
+                future.result()  # re-raise any download error
+    finally:
+        os.close(fd)
+
+def _download_url(url, file_path):
+    print(f"Downloading {url}...")
+    tmp_path = file_path + ".tmp"
+    # Probe for ranged-download support; fall back to a single stream if the
+    # HEAD fails or the server doesn't advertise byte ranges
+    size = None
+    accept_ranges = False
+    try:
+        request = urllib.request.Request(url, method='HEAD')
+        with urllib.request.urlopen(request) as response:
+            size = int(response.headers.get('Content-Length') or 0) or None
+            accept_ranges = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    except Exception:
+        pass
+    if size is not None and accept_ranges and size >= _RANGE_MIN_SIZE:
+        _download_url_ranges(url, tmp_path, size)
+    else:
+        # Stream to a temp file in 1MiB chunks (never buffer the whole payload)
+        with urllib.request.urlopen(url) as response, open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(response, f, length=1024 * 1024)
+    # Atomically publish so a partial download can't poison the cache
+    os.replace(tmp_path, file_path)
+    print(f"Downloaded to {file_path}")
+
 def download_file_with_lock(url, filename):
     """
     Downloads a file from a URL to a local path in the base directory.
-    Uses a lock file to prevent concurrent downloads among multiple ranks.
+    Safe to call from multiple ranks: only one rank downloads, the rest wait.
     """
     base_dir = get_base_dir()
     file_path = os.path.join(base_dir, filename)
-    lock_path = file_path + ".lock"
+
+    dist = _get_dist()
+    if dist is not None and dist.is_initialized():
+        # DDP-idiomatic pattern: rank 0 downloads, everyone else waits at the
+        # barrier. Avoids N flock syscalls and flaky flock semantics over NFS.
+        # exists 快速返回不能放在这个分支之前：那是按 rank、按时刻的文件系统
+        # 检查，哪个 rank 晚到（文件已发布）就会跳过 barrier，让这里的集合
+        # 通信和别处的错配挂死。所有 rank 无条件过同一个 barrier，
+        # exists 只用来决定 rank 0 是否真的需要下载
+        if dist.get_rank() == 0 and not os.path.exists(file_path):
+            _download_url(url, file_path)
+        dist.barrier()
+        return file_path
 
     if os.path.exists(file_path):
         return file_path
 
+    # Before/without process-group init, fall back to an exclusive file lock
+    # to serialize concurrent processes on the same machine
+    lock_path = file_path + ".lock"
     with open(lock_path, 'w') as lock_file:
-
-        # Only a single rank can acquire this lock
-        # All other ranks block until it is released
         fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
-
-        if os.path.exists(file_path):
-            return file_path
-
-        print(f"Downloading {url}...")
-        with urllib.request.urlopen(url) as response:
-            content = response.read().decode('utf-8')
-
-        with open(file_path, 'w') as f:
-            f.write(content)
-
-        print(f"Downloaded to {file_path}")
+        if not os.path.exists(file_path):
+            _download_url(url, file_path)
 
     # Clean up the lock file after the lock is released
     try:
@@ -139,9 +238,19 @@ def download_file_with_lock(url, filename):
 
     return file_path
 
+def _get_dist():
+    """Return torch.distributed if torch is already imported and usable, else None."""
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return None
+    dist = torch.distributed
+    return dist if dist.is_available() else None
+
+# RANK is fixed for the process lifetime; resolve once instead of per print0 call
+_PRINT_RANK = int(os.environ.get('RANK', 0))
+
 def print0(s="",**kwargs):
-    ddp_rank = int(os.environ.get('RANK', 0))
-    if ddp_rank == 0:
+    if _PRINT_RANK == 0:
         print(s, **kwargs)
 
 def print_banner():
@@ -160,10 +269,12 @@ def print_banner():
 
 def is_ddp():
     # TODO is there a proper way
-    return int(os.environ.get('RANK', -1)) != -1
+    return get_dist_info()[0]
 
+@functools.lru_cache(maxsize=1)
 def get_dist_info():
-    if is_ddp():
+    # The launcher env vars are fixed for the process lifetime, so resolve once
+    if int(os.environ.get('RANK', -1)) != -1:
         assert all(var in os.environ for var in ['RANK', 'LOCAL_RANK', 'WORLD_SIZE'])
         ddp_rank = int(os.environ['RANK'])
         ddp_local_rank = int(os.environ['LOCAL_RANK'])
@@ -173,6 +284,7 @@ def get_dist_info():
         return False, 0, 0, 1
 
 def autodetect_device_type():
+    import torch
     # prefer to use CUDA if available, otherwise use MPS, otherwise fallback on CPU
     if torch.cuda.is_available():
         device_type = "cuda"
@@ -185,6 +297,10 @@ def autodetect_device_type():
 
 def compute_init(device_type="cuda"): # cuda|cpu|mps
     """Basic initialization that we keep doing over and over, so make common."""
+    import torch
+    import torch.distributed as dist
+
+    setup_default_logging()
 
     assert device_type in ["cuda", "mps", "cpu"], "Invalid device type atm"
     if device_type == "cuda":
@@ -221,6 +337,7 @@ def compute_init(device_type="cuda"): # cuda|cpu|mps
 def compute_cleanup():
     """Companion function to compute_init, to clean things up before script exit"""
     if is_ddp():
+        import torch.distributed as dist
         dist.destroy_process_group()
 
 class DummyWandb:
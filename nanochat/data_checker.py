@@ -5,40 +5,103 @@
 
 import os
 import sys
-from pathlib import Path
+import functools
 from typing import Dict, List, Tuple
 
 from nanochat.common import get_base_dir
 
+# 所有可用的数据集配置（模块级常量，避免每次检查重建）
+_ALL_DATASETS = {
+    "smoltalk": {
+        "splits": ["train", "test"],
+    },
+    "mmlu": {
+        "configs": ["all", "auxiliary_train"],
+        "splits": ["train", "validation", "dev", "test"],
+    },
+    "humaneval": {
+        "splits": ["test"],
+    },
+    "gsm8k": {
+        "configs": ["main", "socratic"],
+        "splits": ["train", "test"],
+    },
+    "arc": {
+        "configs": ["ARC-Easy", "ARC-Challenge"],
+        "splits": ["train", "validation", "test"],
+    },
+}
+
+# 每个数据集预期的 parquet 文件名，预先展开 configs × splits
+_EXPECTED_FILES = {
+    name: tuple(
+        f"{config}_{split}.parquet" if config else f"{split}.parquet"
+        for config in cfg.get("configs", [None])
+        for split in cfg["splits"]
+    )
+    for name, cfg in _ALL_DATASETS.items()
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _list_dir(path: str):
+    """一次性读取目录内容并缓存，目录不存在时返回 None
+
+    各个 check_* 函数会对同一批目录重复扫描（check_all_data 会把同一数据集
+    检查 3-4 次），缓存后每个目录在整个检查过程中只做一次 scandir
+    """
+    try:
+        return frozenset(e.name for e in os.scandir(path))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
 
-def get_data_dir() -> Path:
+def _rank0_only(check_fn):
+    """装饰器：DDP 下只让 rank 0 执行检查并把结果广播给其他 rank
+
+    每个 rank 独立扫描相同的目录树只会把 NFS stat 流量放大 N 倍；
+    进程组未初始化（或未用 torch）时退化为直接执行
+    """
+    @functools.wraps(check_fn)
+    def wrapper(*args, **kwargs):
+        torch = sys.modules.get("torch")
+        dist = torch.distributed if torch is not None else None
+        if dist is None or not (dist.is_available() and dist.is_initialized()):
+            return check_fn(*args, **kwargs)
+        dist.barrier()
+        result = [check_fn(*args, **kwargs) if dist.get_rank() == 0 else None]
+        dist.broadcast_object_list(result, src=0)
+        return result[0]
+    return wrapper
+
+
+def get_data_dir() -> str:
     """获取数据目录路径"""
     base_dir = get_base_dir()
     # 优先使用 data 目录，如果不存在则使用 base_dir
-    data_dir = Path("data")
-    if not data_dir.exists():
-        data_dir = Path(base_dir)
-    return data_dir
+    if os.path.exists("data"):
+        return "data"
+    return base_dir
 
 
-def check_s3_files(data_dir: Path) -> Tuple[bool, List[str]]:
+def check_s3_files(data_dir: str) -> Tuple[bool, List[str]]:
     """检查 S3 文件是否存在"""
     missing = []
 
     # 检查 eval_bundle
-    eval_bundle_path = data_dir / "eval_bundle"
-    if not eval_bundle_path.exists() or not any(eval_bundle_path.iterdir()):
+    eval_bundle_entries = _list_dir(os.path.join(data_dir, "eval_bundle"))
+    if not eval_bundle_entries:
         missing.append("eval_bundle (evaluation data)")
 
     # 检查 identity_conversations.jsonl
-    identity_path = data_dir / "identity_conversations.jsonl"
-    if not identity_path.exists():
+    root_entries = _list_dir(data_dir) or frozenset()
+    if "identity_conversations.jsonl" not in root_entries:
         missing.append("identity_conversations.jsonl")
 
     return len(missing) == 0, missing
 
 
-def check_huggingface_datasets(data_dir: Path, required_datasets: List[str] = None) -> Tuple[bool, List[str]]:
+def check_huggingface_datasets(data_dir: str, required_datasets: List[str] = None) -> Tuple[bool, List[str]]:
     """
     检查 HuggingFace 数据集是否存在
 
@@ -46,59 +109,26 @@ def check_huggingface_datasets(data_dir: Path, required_datasets: List[str] = No
         data_dir: 数据目录
         required_datasets: 需要检查的数据集列表，如果为 None 则检查所有
     """
-    # 所有可用的数据集配置
-    all_datasets = {
-        "smoltalk": {
-            "splits": ["train", "test"],
-        },
-        "mmlu": {
-            "configs": ["all", "auxiliary_train"],
-            "splits": ["train", "validation", "dev", "test"],
-        },
-        "humaneval": {
-            "splits": ["test"],
-        },
-        "gsm8k": {
-            "configs": ["main", "socratic"],
-            "splits": ["train", "test"],
-        },
-        "arc": {
-            "configs": ["ARC-Easy", "ARC-Challenge"],
-            "splits": ["train", "validation", "test"],
-        },
-    }
-
     # 如果没有指定，检查所有数据集
     if required_datasets is None:
-        required_datasets = list(all_datasets.keys())
+        required_datasets = list(_ALL_DATASETS.keys())
 
     missing = []
 
     for dataset_name in required_datasets:
-        if dataset_name not in all_datasets:
+        if dataset_name not in _ALL_DATASETS:
             missing.append(f"Unknown dataset: {dataset_name}")
             continue
 
-        dataset_config = all_datasets[dataset_name]
-        dataset_dir = data_dir / dataset_name
+        dataset_dir = os.path.join(data_dir, dataset_name)
 
-        if not dataset_dir.exists():
+        # 一次 scandir 读取整个目录（带缓存），避免对每个 (config, split) 组合做一次 stat
+        present = _list_dir(dataset_dir)
+        if present is None:
             missing.append(f"{dataset_name} (entire dataset)")
             continue
 
-        configs = dataset_config.get("configs", [None])
-        splits = dataset_config["splits"]
-
-        missing_files = []
-        for config in configs:
-            for split in splits:
-                if config:
-                    file_name = f"{config}_{split}.parquet"
-                else:
-                    file_name = f"{split}.parquet"
-
-                if not (dataset_dir / file_name).exists():
-                    missing_files.append(file_name)
+        missing_files = [f for f in _EXPECTED_FILES[dataset_name] if f not in present]
 
         if missing_files:
             missing.append(f"{dataset_name}: {', '.join(missing_files)}")
@@ -106,7 +136,7 @@ def check_huggingface_datasets(data_dir: Path, required_datasets: List[str] = No
     return len(missing) == 0, missing
 
 
-def check_base_data(data_dir: Path, min_shards: int = 1) -> Tuple[bool, List[str]]:
+def check_base_data(data_dir: str, min_shards: int = 1) -> Tuple[bool, List[str]]:
     """
     检查基础训练数据是否存在
 
@@ -116,24 +146,32 @@ def check_base_data(data_dir: Path, min_shards: int = 1) -> Tuple[bool, List[str
     """
     missing = []
 
-    base_data_dir = data_dir / "base_data"
-    if not base_data_dir.exists():
+    base_data_dir = os.path.join(data_dir, "base_data")
+    if not os.path.isdir(base_data_dir):
         missing.append(f"base_data directory")
         return False, missing
 
-    parquet_files = list(base_data_dir.glob("shard_*.parquet"))
-    if len(parquet_files) < min_shards:
-        missing.append(f"base_data shards (found {len(parquet_files)}, need at least {min_shards})")
+    # 数到 min_shards 就提前退出，无需枚举整个目录（shard 可能有上千个）
+    num_shards = 0
+    for entry in os.scandir(base_data_dir):
+        if entry.name.startswith("shard_") and entry.name.endswith(".parquet"):
+            num_shards += 1
+            if num_shards >= min_shards:
+                break
+    if num_shards < min_shards:
+        missing.append(f"base_data shards (found {num_shards}, need at least {min_shards})")
 
     return len(missing) == 0, missing
 
 
+@_rank0_only
 def check_tokenizer_data(min_shards: int = 1) -> Tuple[bool, List[str]]:
     """检查 tokenizer 训练所需的数据"""
     data_dir = get_data_dir()
     return check_base_data(data_dir, min_shards)
 
 
+@_rank0_only
 def check_base_training_data(min_shards: int = 10) -> Tuple[bool, List[str]]:
     """检查基础模型训练所需的数据"""
     all_missing = []
@@ -148,6 +186,7 @@ def check_base_training_data(min_shards: int = 10) -> Tuple[bool, List[str]]:
     return len(all_missing) == 0, all_missing
 
 
+@_rank0_only
 def check_mid_training_data() -> Tuple[bool, List[str]]:
     """检查中期训练所需的数据"""
     all_missing = []
@@ -168,6 +207,7 @@ def check_mid_training_data() -> Tuple[bool, List[str]]:
     return len(all_missing) == 0, all_missing
 
 
+@_rank0_only
 def check_sft_training_data() -> Tuple[bool, List[str]]:
     """检查 SFT 训练所需的数据"""
     all_missing = []
@@ -188,6 +228,7 @@ def check_sft_training_data() -> Tuple[bool, List[str]]:
     return len(all_missing) == 0, all_missing
 
 
+@_rank0_only
 def check_evaluation_data() -> Tuple[bool, List[str]]:
     """检查评估所需的数据"""
     all_missing = []
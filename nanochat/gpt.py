@@ -273,7 +273,8 @@ class GPT(nn.Module):
             logits = self.lm_head(x)
             logits = softcap * torch.tanh(logits / softcap) # logits softcap
             logits = logits.float() # use tf32/fp32 for logits
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1, reduction=loss_reduction)
+            # .long() is a no-op for int64 targets; lets callers ship int32 targets over PCIe
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1).long(), ignore_index=-1, reduction=loss_reduction)
             return loss
         else:
             # inference mode: compute and return the logits
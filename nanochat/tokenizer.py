@@ -255,6 +255,21 @@ class RustBPETokenizer:
             pickle.dump(self.enc, f)
         print(f"Saved tokenizer encoding to {pickle_path}")
 
+    @staticmethod
+    def _normalized_messages(conversation):
+        """Return the messages of a conversation, merging a leading system message into the user message."""
+        if conversation["messages"][0]["role"] == "system":
+            # some conversation surgery is necessary here for now...
+            conversation = copy.deepcopy(conversation) # avoid mutating the original
+            messages = conversation["messages"]
+            assert messages[1]["role"] == "user", "System message must be followed by a user message"
+            messages[1]["content"] = messages[0]["content"] + "\n\n" + messages[1]["content"]
+            messages = messages[1:]
+        else:
+            messages = conversation["messages"]
+        assert len(messages) >= 1, f"Conversation has less than 1 message: {messages}"
+        return messages
+
     def render_conversation(self, conversation, max_tokens=2048):
         """
         Tokenize a single Chat conversation (which we call a "doc" or "document" here).
@@ -262,6 +277,32 @@ class RustBPETokenizer:
         - ids: list[int] is a list of token ids of this rendered conversation
         - mask: list[int] of same length, mask = 1 for tokens that the Assistant is expected to train on.
         """
+        messages = self._normalized_messages(conversation)
+        return self._render_messages(messages, self.encode, max_tokens)
+
+    def render_conversations(self, conversations, max_tokens=2048, num_threads=8):
+        """
+        Batched version of render_conversation. Encodes the text of all
+        conversations in a single encode_ordinary_batch call (multi-threaded in
+        Rust), then assembles ids/mask per conversation. Output is identical to
+        calling render_conversation in a loop, with the per-call BPE overhead
+        amortized over the batch. Returns a list of (ids, mask) tuples.
+        """
+        all_messages = [self._normalized_messages(c) for c in conversations]
+        # collect every text chunk in the exact order _render_messages encodes them
+        texts = []
+        for messages in all_messages:
+            for message in messages:
+                content = message["content"]
+                if isinstance(content, str):
+                    texts.append(content)
+                elif isinstance(content, list):
+                    texts.extend(part["text"] for part in content)
+        encoded = iter(self.encode(texts, num_threads=num_threads) if texts else [])
+        encode_fn = lambda _text: next(encoded)
+        return [self._render_messages(messages, encode_fn, max_tokens) for messages in all_messages]
+
+    def _render_messages(self, messages, encode_fn, max_tokens):
         # ids, masks that we will return and a helper function to help build them up.
         ids, mask = [], []
         def add_tokens(token_ids, mask_val):
@@ -270,19 +311,6 @@ class RustBPETokenizer:
             ids.extend(token_ids)
             mask.extend([mask_val] * len(token_ids))
 
-        # sometimes the first message is a system message...
-        # => just merge it with the second (user) message
-        if conversation["messages"][0]["role"] == "system":
-            # some conversation surgery is necessary here for now...
-            conversation = copy.deepcopy(conversation) # avoid mutating the original
-            messages = conversation["messages"]
-            assert messages[1]["role"] == "user", "System message must be followed by a user message"
-            messages[1]["content"] = messages[0]["content"] + "\n\n" + messages[1]["content"]
-            messages = messages[1:]
-        else:
-            messages = conversation["messages"]
-        assert len(messages) >= 1, f"Conversation has less than 1 message: {messages}"
-
         # fetch all the special tokens we need
         bos = self.get_bos_token_id()
         user_start, user_end = self.encode_special("<|user_start|>"), self.encode_special("<|user_end|>")
@@ -303,7 +331,7 @@ class RustBPETokenizer:
 
             if message["role"] == "user":
                 assert isinstance(content, str), "User messages are simply expected to be strings"
-                value_ids = self.encode(content)
+                value_ids = encode_fn(content)
                 add_tokens(user_start, 0)
                 add_tokens(value_ids, 0)
                 add_tokens(user_end, 0)
@@ -311,11 +339,11 @@ class RustBPETokenizer:
                 add_tokens(assistant_start, 0)
                 if isinstance(content, str):
                     # simple string => simply add the tokens
-                    value_ids = self.encode(content)
+                    value_ids = encode_fn(content)
                     add_tokens(value_ids, 1)
                 elif isinstance(content, list):
                     for part in content:
-                        value_ids = self.encode(part["text"])
+                        value_ids = encode_fn(part["text"])
                         if part["type"] == "text":
                             # string part => simply add the tokens
                             add_tokens(value_ids, 1)
@@ -6,9 +6,43 @@ This script downloads all datasets used in the nanochat project.
 
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import pyarrow as pa
+import pyarrow.parquet as pq
 from datasets import load_dataset
 
+# Rows per parquet write; bounds peak memory while streaming and doubles as
+# the row-group size of the emitted files (aligned with mini-batch scans)
+WRITE_BATCH_SIZE = 131_072
+
+def _make_writer(local_path, schema):
+    # ZSTD level 3 shrinks files ~20-30% vs the default Snappy at similar
+    # encode speed; every downstream reader auto-negotiates the codec
+    return pq.ParquetWriter(str(local_path), schema, compression='zstd', compression_level=3)
+
+def write_streaming_parquet(ds, local_path):
+    """Write an IterableDataset to parquet in batches without materializing it."""
+    writer = None
+    batch = []
+    try:
+        for example in ds:
+            batch.append(example)
+            if len(batch) >= WRITE_BATCH_SIZE:
+                table = pa.Table.from_pylist(batch)
+                if writer is None:
+                    writer = _make_writer(local_path, table.schema)
+                writer.write_table(table)
+                batch = []
+        if batch or writer is None:
+            table = pa.Table.from_pylist(batch)
+            if writer is None:
+                writer = _make_writer(local_path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
 # Dataset configurations
 DATASETS = [
     {
@@ -61,35 +95,48 @@ def download_dataset(dataset_config, data_dir, force=False):
     configs = dataset_config.get("configs", [None])
     splits = dataset_config["splits"]
 
+    # Collect the (config, split) pairs that still need downloading
+    tasks = []
     for config in configs:
         for split in splits:
+            file_name = f"{config}_{split}.parquet" if config else f"{split}.parquet"
+            local_path = dataset_dir / file_name
+            if local_path.exists() and not force:
+                label = f"{config}/{split}" if config else split
+                print(f"  Skipping {label} - already exists")
+                continue
+            tasks.append((config, split, local_path))
+
+    def download_one(task):
+        config, split, local_path = task
+        label = f"{config}/{split}" if config else split
+        try:
+            print(f"  Downloading {label}...")
+            # Stream straight from the Hub into parquet; avoids downloading,
+            # Arrow-converting and caching the full dataset before writing
+            if config:
+                ds = load_dataset(repo, name=config, split=split, streaming=True)
+            else:
+                ds = load_dataset(repo, split=split, streaming=True)
+            # Write to a temp path and atomically publish, so concurrent
+            # .exists() checks never observe a half-written parquet
+            tmp_path = local_path.with_suffix(".parquet.tmp")
             try:
-                # Determine local file path
-                if config:
-                    file_name = f"{config}_{split}.parquet"
-                    local_path = dataset_dir / file_name
-                    if local_path.exists() and not force:
-                        print(f"  Skipping {config}/{split} - already exists")
-                        continue
-
-                    print(f"  Downloading {config}/{split}...")
-                    ds = load_dataset(repo, name=config, split=split)
-                else:
-                    file_name = f"{split}.parquet"
-                    local_path = dataset_dir / file_name
-                    if local_path.exists() and not force:
-                        print(f"  Skipping {split} - already exists")
-                        continue
-
-                    print(f"  Downloading {split}...")
-                    ds = load_dataset(repo, split=split)
-
-                # Save to parquet
-                ds.to_parquet(str(local_path))
-                print(f"  Saved to {local_path}")
-
-            except Exception as e:
-                print(f"  Error downloading {config}/{split}: {e}")
+                write_streaming_parquet(ds, tmp_path)
+                os.replace(tmp_path, local_path)
+            except Exception:
+                if tmp_path.exists():
+                    tmp_path.unlink()
+                raise
+            print(f"  Saved to {local_path}")
+        except Exception as e:
+            print(f"  Error downloading {label}: {e}")
+
+    # The downloads are network/disk bound, so a thread pool gives near-linear
+    # speedup (e.g. MMLU is 2 configs x 4 splits = 8 fetches)
+    if tasks:
+        with ThreadPoolExecutor(max_workers=min(8, len(tasks))) as executor:
+            list(executor.map(download_one, tasks))
 
 def main():
     parser = argparse.ArgumentParser(description="Download HuggingFace datasets for offline usage")
@@ -111,8 +158,20 @@ def main():
 
     print(f"Downloading datasets to {data_dir.absolute()}")
 
-    for dataset_config in datasets_to_download:
-        download_dataset(dataset_config, data_dir, args.force)
+    rank = int(os.environ.get("RANK", -1))
+    if rank != -1:
+        # Launched under torchrun: only rank 0 downloads, the other ranks wait
+        # at a barrier instead of racing it for the same parquet files
+        import torch.distributed as dist
+        if not dist.is_initialized():
+            dist.init_process_group(backend="gloo")
+        if rank == 0:
+            for dataset_config in datasets_to_download:
+                download_dataset(dataset_config, data_dir, args.force)
+        dist.barrier()
+    else:
+        for dataset_config in datasets_to_download:
+            download_dataset(dataset_config, data_dir, args.force)
 
     print("Download complete!")
 
@@ -16,13 +16,20 @@ data/
 """
 
 import os
+import re
 import sys
 import time
+import queue
 import argparse
+import threading
+import shutil
 import requests
 import zipfile
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Dict, List, Tuple
+import pyarrow.parquet as pq
 from datasets import load_dataset
 
 # 数据集配置
@@ -77,6 +84,13 @@ S3_FILES = [
     }
 ]
 
+# HTTP 会话：跨请求复用 TCP+TLS 连接，避免 1822+ 个 shard 每个都重新握手
+_SESSION = requests.Session()
+_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=0))
+
+# 流式下载的 chunk 大小：8MiB，减少 Python 层循环次数
+HTTP_CHUNK = 8 * 1024 * 1024
+
 # FineWeb-Edu 配置
 BASE_DATA_CONFIG = {
     "url_template": "https://www.modelscope.cn/datasets/Thackeray/karpathy-fineweb-edu-100b-shuffle-240shard/resolve/master/shard_{:05d}.parquet",
@@ -85,20 +99,58 @@ BASE_DATA_CONFIG = {
 }
 
 
+def _pipelined_write(response, temp_path: str, chunk_size: int):
+    """边下边写：网络读取和磁盘写入在两个线程中流水线并行
+
+    单线程时每个 chunk 的 write() 会阻塞下一次网络读取；
+    用一个有界队列 + 写线程让两者重叠，不额外占用内存
+    """
+    chunk_queue: queue.Queue = queue.Queue(maxsize=4)
+    write_error = []
+
+    def writer():
+        try:
+            with open(temp_path, 'wb') as f:
+                while True:
+                    chunk = chunk_queue.get()
+                    if chunk is None:
+                        break
+                    f.write(chunk)
+        except IOError as e:
+            write_error.append(e)
+            # 写失败（如磁盘满）后继续把队列排空到哨兵为止，
+            # 否则网络线程会永远卡在满队列的 put 上，错误无法冒出去触发重试
+            while chunk_queue.get() is not None:
+                pass
+
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.start()
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if write_error:
+                break # 写线程已失败，剩余数据不必再拉
+            if chunk:
+                chunk_queue.put(chunk)
+    finally:
+        chunk_queue.put(None)
+        writer_thread.join()
+    if write_error:
+        raise write_error[0]
+
+
 def download_file_with_retry(url: str, filepath: str, max_attempts: int = 5) -> bool:
     """带重试机制的文件下载"""
     for attempt in range(1, max_attempts + 1):
         try:
             print(f"  尝试 {attempt}/{max_attempts}: 下载 {os.path.basename(filepath)}...")
-            response = requests.get(url, stream=True, timeout=60)
+            # identity 编码：parquet 已经压缩过，避免服务端再做一层 gzip
+            response = _SESSION.get(url, stream=True, timeout=60,
+                                    headers={"Accept-Encoding": "identity"})
             response.raise_for_status()
 
-            # 写入临时文件
+            # 写入临时文件（读写流水线并行）
             temp_path = filepath + ".tmp"
-            with open(temp_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024 * 1024):  # 1MB chunks
-                    if chunk:
-                        f.write(chunk)
+            _pipelined_write(response, temp_path, chunk_size=HTTP_CHUNK)
 
             # 移动到最终位置
             os.rename(temp_path, filepath)
@@ -126,6 +178,33 @@ def download_file_with_retry(url: str, filepath: str, max_attempts: int = 5) ->
     return False
 
 
+def download_and_extract_zip(url: str, data_dir: Path, max_attempts: int = 3) -> bool:
+    """下载 ZIP 并直接从响应流解压，不在磁盘上落地中间 .zip 文件
+
+    之前是先写完整 .zip 再重新打开解压再删除，数据在 SSD 上来回过两遍；
+    现在响应体进入 SpooledTemporaryFile（小于 256MB 时留在内存），解压一次落盘
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            print(f"  尝试 {attempt}/{max_attempts}: 下载并解压...")
+            with _SESSION.get(url, stream=True, timeout=60,
+                              headers={"Accept-Encoding": "identity"}) as response:
+                response.raise_for_status()
+                with SpooledTemporaryFile(max_size=256 << 20) as tmp:
+                    shutil.copyfileobj(response.raw, tmp, length=HTTP_CHUNK)
+                    tmp.seek(0)
+                    with zipfile.ZipFile(tmp) as zip_ref:
+                        zip_ref.extractall(data_dir)
+            return True
+        except (requests.RequestException, zipfile.BadZipFile, IOError) as e:
+            print(f"  ✗ 下载或解压失败: {e}")
+            if attempt < max_attempts:
+                wait_time = 2 ** attempt
+                print(f"  等待 {wait_time} 秒后重试...")
+                time.sleep(wait_time)
+    return False
+
+
 def download_s3_files(data_dir: Path) -> bool:
     """下载 S3 文件"""
     print("\n" + "="*60)
@@ -147,18 +226,8 @@ def download_s3_files(data_dir: Path) -> bool:
                 continue
 
             print(f"\n下载并解压 {name}...")
-            zip_path = data_dir / f"{name}.zip"
-
-            if download_file_with_retry(url, str(zip_path)):
-                try:
-                    extract_to.mkdir(parents=True, exist_ok=True)
-                    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                        zip_ref.extractall(data_dir)
-                    os.remove(zip_path)
-                    print(f"  ✓ 解压成功: {extract_to}")
-                except Exception as e:
-                    print(f"  ✗ 解压失败: {e}")
-                    all_success = False
+            if download_and_extract_zip(url, data_dir):
+                print(f"  ✓ 解压成功: {extract_to}")
             else:
                 all_success = False
 
@@ -190,40 +259,43 @@ def download_huggingface_dataset(dataset_config: dict, data_dir: Path, force: bo
     configs = dataset_config.get("configs", [None])
     splits = dataset_config["splits"]
 
-    all_success = True
-
+    # 收集还需要下载的 (config, split) 组合
+    tasks = []
     for config in configs:
         for split in splits:
-            try:
-                # 确定本地文件路径
-                if config:
-                    file_name = f"{config}_{split}.parquet"
-                    local_path = dataset_dir / file_name
-                    if local_path.exists() and not force:
-                        print(f"  ✓ {config}/{split} 已存在，跳过")
-                        continue
-
-                    print(f"  下载 {config}/{split}...")
-                    ds = load_dataset(repo, name=config, split=split)
-                else:
-                    file_name = f"{split}.parquet"
-                    local_path = dataset_dir / file_name
-                    if local_path.exists() and not force:
-                        print(f"  ✓ {split} 已存在，跳过")
-                        continue
+            file_name = f"{config}_{split}.parquet" if config else f"{split}.parquet"
+            local_path = dataset_dir / file_name
+            if local_path.exists() and not force:
+                label = f"{config}/{split}" if config else split
+                print(f"  ✓ {label} 已存在，跳过")
+                continue
+            tasks.append((config, split, local_path))
 
-                    print(f"  下载 {split}...")
-                    ds = load_dataset(repo, split=split)
+    def download_one(task) -> bool:
+        config, split, local_path = task
+        label = f"{config}/{split}" if config else split
+        try:
+            print(f"  下载 {label}...")
+            if config:
+                ds = load_dataset(repo, name=config, split=split)
+            else:
+                ds = load_dataset(repo, split=split)
+            # 保存为 parquet：直接写底层 Arrow 表，多线程编码 + zstd 压缩
+            pq.write_table(ds.data.table, str(local_path), compression='zstd', use_threads=True)
+            print(f"  ✓ 保存到 {local_path}")
+            return True
+        except Exception as e:
+            print(f"  ✗ 下载失败 {label}: {e}")
+            return False
 
-                # 保存为 parquet
-                ds.to_parquet(str(local_path))
-                print(f"  ✓ 保存到 {local_path}")
+    if not tasks:
+        return True
 
-            except Exception as e:
-                print(f"  ✗ 下载失败 {config}/{split}: {e}")
-                all_success = False
+    # 网络 I/O 为主，线程池可以让一个 split 的下载和另一个的 parquet 编码重叠
+    with ThreadPoolExecutor(max_workers=min(8, len(tasks))) as executor:
+        results = list(executor.map(download_one, tasks))
 
-    return all_success
+    return all(results)
 
 
 def download_huggingface_datasets(data_dir: Path, force: bool = False) -> bool:
@@ -241,6 +313,36 @@ def download_huggingface_datasets(data_dir: Path, force: bool = False) -> bool:
     return all_success
 
 
+_SHARD_RE = re.compile(r"shard_(\d+)\.parquet$")
+
+
+def _shard_bitmap(base_data_dir: Path, max_shard: int) -> bytearray:
+    """一次 readdir 把已存在的 shard 标进 bitmap，代替每个 shard 一次 stat
+
+    1823 个 shard 逐个 .exists() 是 1823 次 stat 系统调用外加同样多的
+    Path 对象分配；bitmap 只做一次 scandir，按 shard 编号索引
+    """
+    present = bytearray(max_shard + 1)
+    try:
+        entries = os.scandir(base_data_dir)
+    except FileNotFoundError:
+        return present
+    for e in entries:
+        m = _SHARD_RE.match(e.name)
+        if m:
+            index = int(m.group(1))
+            if index <= max_shard:
+                present[index] = 1
+    return present
+
+
+def _download_shard(base_data_dir: Path, index: int) -> bool:
+    """下载单个 FineWeb shard（调用方保证尚不存在）"""
+    filepath = base_data_dir / f"shard_{index:05d}.parquet"
+    url = BASE_DATA_CONFIG["url_template"].format(index)
+    return download_file_with_retry(url, str(filepath))
+
+
 def download_base_data(data_dir: Path, num_shards: int = -1, num_workers: int = 1) -> bool:
     """下载基础训练数据 (FineWeb-Edu)"""
     print("\n" + "="*60)
@@ -256,48 +358,39 @@ def download_base_data(data_dir: Path, num_shards: int = -1, num_workers: int =
     print(f"准备下载 {num} 个 shards (0-{num-1})")
     print(f"目标目录: {base_data_dir}")
 
-    # 检查已存在的文件
-    existing_files = list(base_data_dir.glob("shard_*.parquet"))
-    print(f"已存在 {len(existing_files)} 个 shard 文件")
-
-    if num_workers > 1:
-        # 多进程下载
-        from multiprocessing import Pool
-
-        def download_shard(index: int) -> bool:
-            filename = f"shard_{index:05d}.parquet"
-            filepath = base_data_dir / filename
-
-            if filepath.exists():
-                return True
-
-            url = BASE_DATA_CONFIG["url_template"].format(index)
-            return download_file_with_retry(url, str(filepath))
-
-        print(f"使用 {num_workers} 个进程并行下载...")
-        with Pool(processes=num_workers) as pool:
-            results = pool.map(download_shard, range(num))
-
-        success_count = sum(1 for r in results if r)
-        print(f"\n下载完成: {success_count}/{num} 个 shards")
-        return success_count == num
-    else:
-        # 单进程下载
-        success_count = 0
-        for i in range(num):
-            filename = f"shard_{i:05d}.parquet"
-            filepath = base_data_dir / filename
-
-            if filepath.exists():
+    # 一次 scandir 建 bitmap，只下载缺失的 shard
+    present = _shard_bitmap(base_data_dir, max_shard)
+    missing = [i for i in range(num) if not present[i]]
+    print(f"已存在 {num - len(missing)} 个 shard 文件")
+    if not missing:
+        print(f"\n下载完成: {num}/{num} 个 shards")
+        return True
+
+    # 线程池下载：shard 下载是纯网络 I/O，线程比进程省掉 fork 和 pickle 开销，
+    # 还能共享同一个 _SESSION 的连接池
+    print(f"使用 {num_workers} 个线程并行下载 {len(missing)} 个缺失 shard...")
+    success_count = 0
+    done_count = 0
+    total = len(missing)
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        futures = [executor.submit(_download_shard, base_data_dir, i) for i in missing]
+        for future in as_completed(futures):
+            done_count += 1
+            if future.result():
                 success_count += 1
-                continue
+            if done_count % 50 == 0 or done_count == total:
+                print(f"  进度: {done_count}/{total} (成功 {success_count})")
+
+    print(f"\n下载完成: {num - total + success_count}/{num} 个 shards")
+    return success_count == total
 
-            url = BASE_DATA_CONFIG["url_template"].format(i)
-            if download_file_with_retry(url, str(filepath)):
-                success_count += 1
 
-        print(f"\n下载完成: {success_count}/{num} 个 shards")
-        return success_count == num
+def _list_dir_names(path: Path) -> set:
+    """一次 scandir 读取目录下所有条目名，目录不存在时返回空集合"""
+    try:
+        return {e.name for e in os.scandir(path)}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
 
 
 def check_data_integrity(data_dir: Path) -> Tuple[bool, List[str]]:
@@ -338,6 +431,8 @@ def check_data_integrity(data_dir: Path) -> Tuple[bool, List[str]]:
             missing_items.append(f"HF Dataset: {local_name}")
             continue
 
+        # 一次 scandir 代替每个文件一次 stat
+        present = _list_dir_names(dataset_dir)
         configs = dataset_config.get("configs", [None])
         splits = dataset_config["splits"]
         missing_files = []
@@ -349,7 +444,7 @@ def check_data_integrity(data_dir: Path) -> Tuple[bool, List[str]]:
                 else:
                     file_name = f"{split}.parquet"
 
-                if not (dataset_dir / file_name).exists():
+                if file_name not in present:
                     missing_files.append(file_name)
 
         if missing_files:
@@ -369,12 +464,13 @@ def check_data_integrity(data_dir: Path) -> Tuple[bool, List[str]]:
         print(f"  ✗ 缺失基础训练数据目录")
         missing_items.append("Base training data")
     else:
-        parquet_files = list(base_data_dir.glob("shard_*.parquet"))
-        if len(parquet_files) == 0:
+        # 复用下载时的 bitmap 逻辑：一次 readdir 统计
+        num_shards_found = sum(_shard_bitmap(base_data_dir, BASE_DATA_CONFIG["max_shard"]))
+        if num_shards_found == 0:
             print(f"  ✗ 没有找到任何 shard 文件")
             missing_items.append("Base training data shards")
         else:
-            print(f"  ✓ 找到 {len(parquet_files)} 个 shard 文件")
+            print(f"  ✓ 找到 {num_shards_found} 个 shard 文件")
 
     # 总结
     print("\n" + "="*60)
@@ -9,11 +9,13 @@ torchrun --standalone --nproc_per_node=4 -m scripts.t4_mid_train
 python -m scripts.t4_mid_train
 """
 
-from collections import deque
 import os
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
 import time
+import queue
+import threading
 import wandb
+import numpy as np
 import torch
 from contextlib import nullcontext
 from nanochat.common import compute_init, compute_cleanup, print0, DummyWandb, get_base_dir, autodetect_device_type
@@ -78,6 +80,13 @@ user_config = {k: globals()[k] for k in config_keys} # possibly useful for loggi
 device_type = autodetect_device_type() if device_type == "" else device_type
 ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
 master_process = ddp_rank == 0
+if device_type == "cuda":
+    # autocast 覆盖不到的零散 FP32 matmul（优化器、unembedding 等）允许走 TF32，
+    # T4 (SM7.5) 上无 TF32 tensor core 会静默退回 FP32，开着无害；
+    # 形状完全静态，cudnn.benchmark 的首步 autotune 只会白白卡一次
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = False
 autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=torch.bfloat16) if device_type == "cuda" else nullcontext()
 synchronize = torch.cuda.synchronize if device_type == "cuda" else lambda: None
 get_max_memory = torch.cuda.max_memory_allocated if device_type == "cuda" else lambda: 0
@@ -96,7 +105,9 @@ if use_gradient_checkpointing:
     model.gradient_checkpointing = True
     print0("✓ Gradient checkpointing enabled for memory efficiency")
 orig_model = model
-model = torch.compile(model, dynamic=False)
+# 形状完全静态（device_batch_size x max_seq_len 固定），reduce-overhead 模式
+# 启用 CUDA graph 捕获，把每步上千次 kernel launch 换成一次 graph 回放
+model = torch.compile(model, mode="reduce-overhead", dynamic=False)
 depth = model.config.n_layer
 num_flops_per_token = model.estimate_flops()
 tokens_per_fwdbwd = device_batch_size * max_seq_len # tokens per iteration for a single rank
@@ -141,43 +152,124 @@ val_dataset = TaskMixture([
     GSM8K(subset="main", split="test", stop=420), # 1.32K rows in test set, use only 420 to match the train ratios
 ]) # total: 24K + 14K + 1.32K ~= 39K rows
 
+# Token 缓存：tokenization 是 (row, tokenizer) 的纯函数，TaskMixture 的行序也是
+# 确定性的（seed=42 shuffle），但原来每个 epoch、每次重跑都重新执行
+# render_conversation。把整份 mixture 的 token id 持久化为 int32 bin + offsets，
+# 第 2 个 epoch 和所有重跑只剩 mmap 读取（页缓存在 rank 间自动共享）。
+token_cache_dir = os.path.join(get_base_dir(), "midtrain_token_cache")
+
+def _token_cache_paths(split, dataset):
+    # vocab size 和行数一起编进文件名，tokenizer 或数据配比变化时自动失效
+    tag = f"{split}_v{tokenizer.get_vocab_size()}_n{len(dataset)}"
+    return (os.path.join(token_cache_dir, f"{tag}_tokens.bin"),
+            os.path.join(token_cache_dir, f"{tag}_offsets.npy"))
+
+def _build_token_cache(split, dataset):
+    tokens_path, offsets_path = _token_cache_paths(split, dataset)
+    os.makedirs(token_cache_dir, exist_ok=True)
+    offsets = np.zeros(len(dataset) + 1, dtype=np.int64)
+    tmp_path = tokens_path + ".tmp"
+    batch_size = 512 # 攒一批行再做一次批量 BPE（Rust 侧多线程），摊薄每次调用的开销
+    with open(tmp_path, "wb") as f:
+        for start in range(0, len(dataset), batch_size):
+            rows = [dataset[i] for i in range(start, min(start + batch_size, len(dataset)))]
+            rendered = tokenizer.render_conversations(rows)
+            for j, (ids, _) in enumerate(rendered):
+                i = start + j
+                np.asarray(ids, dtype=np.int32).tofile(f)
+                offsets[i + 1] = offsets[i] + len(ids)
+    np.save(offsets_path, offsets)
+    os.replace(tmp_path, tokens_path) # 原子发布，半成品不会被当成有效缓存
+
+def _load_token_cache(split, dataset):
+    tokens_path, offsets_path = _token_cache_paths(split, dataset)
+    if master_process and not (os.path.exists(tokens_path) and os.path.exists(offsets_path)):
+        print0(f"构建 {split} token 缓存（一次性，后续运行直接复用）...")
+        _build_token_cache(split, dataset)
+    # barrier 必须无条件执行：exists 判断是按 rank、按时刻的，哪个 rank 晚到
+    # （缓存刚好已发布）就会跳过这里的 barrier，让它和后面的集合通信错位挂死
+    if ddp:
+        dist.barrier() # 其他 rank 等 rank 0 写完
+    offsets = np.load(offsets_path)
+    tokens = np.memmap(tokens_path, dtype=np.int32, mode="r")
+    return tokens, offsets
+
+train_token_cache = _load_token_cache("train", train_dataset)
+val_token_cache = _load_token_cache("val", val_dataset)
+
 # DataLoader is defined here, it emits inputs, targets : 2D tensors of shape (device_batch_size, max_seq_len)
+# 生产者（预取线程里的 generator）只置位 local_last_step，置 True 后不再复位；
+# 训练循环的 last_step 由它导出（DDP 下是跨 rank 归约的结果），两者分开，
+# 归约结果不会把生产者刚置起的信号覆盖掉
+local_last_step = False # producer-observed end of dataset / iteration budget, sticky
 last_step = False # we will toggle this to True when we reach the end of the dataset
 approx_progress = 0.0 # will go from 0 to 1 over the course of the epoch
+
+# 预取深度：训练侧后台线程最多提前准备这么多个 micro-batch
+PREFETCH_DEPTH = 4
+
+# 固定内存缓冲池：val loader 每 75 步评估都会重建一次 generator，
+# 复用已 pin 的缓冲避免每次评估都付一次 cudaHostAlloc 的代价。
+# 按 split 区分，train/val 两个 generator 可以同时存活而互不干扰。
+_scratch_cache = {}
+def _get_scratch(split, needed_tokens):
+    scratch = _scratch_cache.get(split)
+    if scratch is None or scratch.numel() < needed_tokens:
+        # int32 足够放下词表（vocab ~64K），跨 PCIe 的传输量比 int64 减半
+        scratch = torch.empty(needed_tokens, dtype=torch.int32, pin_memory=(device_type == "cuda"))
+        _scratch_cache[split] = scratch
+    return scratch[:needed_tokens]
+
 def mid_data_generator(split):
-    global last_step, approx_progress
+    global local_last_step, approx_progress
     assert split in {"train", "val"}, "split must be 'train' or 'val'"
     dataset = train_dataset if split == "train" else val_dataset
+    tokens_mmap, offsets = train_token_cache if split == "train" else val_token_cache
     dataset_size = len(dataset)
     assert dataset_size > 0
     needed_tokens = device_batch_size * max_seq_len + 1 # to form one training batch of inputs,targets
-    token_buffer = deque()
-    # CUDA supports memory pinning for faster transfers between CPU and GPU:
-    scratch = torch.empty(needed_tokens, dtype=torch.int64, pin_memory=(device_type == "cuda"))
+    token_buffer = [] # token 先攒在 list 里，整段向量化拷入 scratch
+    # CUDA supports memory pinning for faster transfers between CPU and GPU.
+    # 轮换多块 scratch，并给每块配一个 CUDA event：队列只限制生产者相对消费者
+    # get 的步调，不限制相对 GPU 执行的步调——GPU 落后入队点多个 micro-batch 时
+    # （grad_accum_steps 单卡可达 32），光靠轮换数量挡不住生产者绕回一块
+    # H2D 还在排队的缓冲；重写前先等该缓冲上一轮的拷贝真正完成
+    scratch_bufs = [_get_scratch((split, j), needed_tokens) for j in range(PREFETCH_DEPTH + 2)]
+    scratch_events = [None] * len(scratch_bufs) if device_type == "cuda" else None
     cursor = ddp_rank # increments by ddp_world_size each time, so each rank processes unique documents
     it = 0 # iteration counter
     while True:
+        slot = it % len(scratch_bufs)
+        scratch = scratch_bufs[slot]
         # Accumulate enough tokens for one iteration before yielding
         while len(token_buffer) < needed_tokens:
-            conversation = dataset[cursor]
-            ids, _ = tokenizer.render_conversation(conversation)
-            token_buffer.extend(ids)
+            # 从缓存读 token id，跳过 render_conversation
+            ids = tokens_mmap[offsets[cursor]:offsets[cursor + 1]]
+            token_buffer.extend(ids.tolist())
             cursor += ddp_world_size
             if cursor >= dataset_size:
                 cursor -= dataset_size # wrap around for another epoch
                 if split == "train":
-                    last_step = True # toggle last_step to True, which will terminate the training loop
+                    local_last_step = True # toggle to True, which will terminate the training loop
         # Stopping condition to respect num_iterations, if given
         it += 1
         if num_iterations > 0 and it >= num_iterations:
-            last_step = True # toggle last_step to True, which will terminate the training loop
+            local_last_step = True # toggle to True, which will terminate the training loop
         # Build up inputs/targets and yield
-        for i in range(needed_tokens):
-            scratch[i] = token_buffer.popleft()
-        inputs_cpu = scratch[:-1].to(dtype=torch.int32)
-        targets_cpu = scratch[1:]
-        inputs = inputs_cpu.view(device_batch_size, max_seq_len).to(device=device, dtype=torch.int32, non_blocking=True)
-        targets = targets_cpu.view(device_batch_size, max_seq_len).to(device=device, dtype=torch.int64, non_blocking=True)
+        if scratch_events is not None and scratch_events[slot] is not None:
+            scratch_events[slot].synchronize() # 这块缓冲上一轮的 H2D 还没完成就先等
+        # 一次 C 级拷贝代替每 batch ~2K 次（每 epoch 数百万次）Python 级逐元素赋值
+        scratch.numpy()[:needed_tokens] = token_buffer[:needed_tokens]
+        del token_buffer[:needed_tokens]
+        # 一次 H2D 传输搬整块 int32 scratch，inputs/targets 在 device 上切片成形；
+        # targets 的 int64 转换放在 device 上做，不占传输带宽
+        scratch_gpu = scratch.to(device=device, non_blocking=True)
+        if scratch_events is not None:
+            if scratch_events[slot] is None:
+                scratch_events[slot] = torch.cuda.Event()
+            scratch_events[slot].record() # 紧跟拷贝入队：event 完成即 scratch 可重写
+        inputs = scratch_gpu[:-1].view(device_batch_size, max_seq_len)
+        targets = scratch_gpu[1:].view(device_batch_size, max_seq_len).long()
         if split == "train":
             if num_iterations > 0:
                 approx_progress = it / num_iterations # calculate progress from the max number of iterations
@@ -185,7 +277,25 @@ def mid_data_generator(split):
                 approx_progress = cursor / dataset_size # approximate progress as a fraction of the dataset
         yield inputs, targets
 
-train_loader = mid_data_generator("train")
+class Prefetcher:
+    """后台线程预取：把 render_conversation 的 CPU 开销移出训练关键路径
+
+    生产者线程在 GPU 计算的同时准备后续 micro-batch（包括 pinned 拷贝和
+    non_blocking 的 H2D 传输，两者都在默认流上，与消费侧天然有序）
+    """
+    def __init__(self, gen, depth=PREFETCH_DEPTH):
+        self.q = queue.Queue(maxsize=depth)
+        self.thread = threading.Thread(target=self._run, args=(gen,), daemon=True)
+        self.thread.start()
+    def _run(self, gen):
+        for item in gen:
+            self.q.put(item)
+    def __iter__(self):
+        return self
+    def __next__(self):
+        return self.q.get()
+
+train_loader = Prefetcher(mid_data_generator("train"))
 build_val_loader = lambda: mid_data_generator("val")
 progress = 0 # will go from 0 to 1 over the course of the epoch
 
@@ -203,20 +313,20 @@ def get_muon_momentum(it):
 # -----------------------------------------------------------------------------
 # Training loop
 x, y = next(train_loader) # prefetch the very first batch of data
+# last_step 的跨 rank 同步用异步 all-reduce 与 optimizer step 重叠（见训练步内）
+last_step_tensor = torch.zeros((), dtype=torch.int32, device=device) if ddp else None
+last_step_handle = None
 min_val_bpb = float("inf")
-smooth_train_loss = 0 # EMA of training loss
+smooth_train_loss = torch.zeros((), device=device) # EMA of training loss，作为 device 张量累积
 ema_beta = 0.9 # EMA decay factor
 total_training_time = 0 # total wall-clock time of training
+grad_seed = None # 反向传播的种子梯度，把 1/grad_accum_steps 折进去，省掉每个 micro-step 的除法 kernel
+last_lrm = None # 上次写入 param_groups 的 lr multiplier / muon momentum
+last_muon_momentum = None
 step = 0
 while True:
     flops_so_far = num_flops_per_token * total_batch_size * step
 
-    # Synchronize last_step across all ranks to avoid hangs in the distributed setting
-    if ddp:
-        last_step_tensor = torch.tensor(last_step, dtype=torch.int32, device=device)
-        dist.all_reduce(last_step_tensor, op=dist.ReduceOp.MAX)
-        last_step = bool(last_step_tensor.item())
-
     # once in a while: evaluate the val bpb (all ranks participate)
     if eval_every > 0 and (last_step or step % eval_every == 0):
         model.eval()
@@ -267,30 +377,53 @@ while True:
     # single training step
     synchronize()
     t0 = time.time()
+    # 注意：这里没有 DDP wrapper（也就不需要 no_sync()）——梯度在 optimizer.step()
+    # 内部做一次 reduce_scatter(AVG)（见 muon.py/adamw.py），每步只同步一次，
+    # 非最后一个 micro-step 天然零通信
     for micro_step in range(grad_accum_steps):
         with autocast_ctx:
             loss = model(x, y)
         train_loss = loss.detach()
-        loss = loss / grad_accum_steps
-        loss.backward()
+        if grad_seed is None:
+            grad_seed = torch.full_like(loss, 1.0 / grad_accum_steps)
+        loss.backward(gradient=grad_seed)
         x, y = next(train_loader)
         progress = max(progress, approx_progress)
-    
+    # Synchronize last_step across all ranks to avoid hangs in the distributed
+    # setting. 必须在最后一次 next(train_loader) 之后再捕获：生产者只在
+    # micro-step 取数腾出队列空位时运行，步首捕获会漏掉它本步置起的信号。
+    # 异步发起，与 optimizer step 重叠，步末取归约结果，各 rank 一致
+    if ddp:
+        last_step_tensor.fill_(int(local_last_step))
+        last_step_handle = dist.all_reduce(last_step_tensor, op=dist.ReduceOp.MAX, async_op=True)
+
     # step the optimizers
+    # lrm 在前 80% 训练过程中恒为 1，muon momentum 在 300 步后饱和——
+    # 只有值变化时才重写 param_groups，避免每步的 Python dict 遍历
     lrm = get_lr_multiplier(progress)
-    for opt in optimizers:
-        for group in opt.param_groups:
-            group["lr"] = group["initial_lr"] * lrm
+    if lrm != last_lrm:
+        for opt in optimizers:
+            for group in opt.param_groups:
+                group["lr"] = group["initial_lr"] * lrm
+        last_lrm = lrm
     muon_momentum = get_muon_momentum(step)
-    for group in muon_optimizer.param_groups:
-        group["momentum"] = muon_momentum
+    if muon_momentum != last_muon_momentum:
+        for group in muon_optimizer.param_groups:
+            group["momentum"] = muon_momentum
+        last_muon_momentum = muon_momentum
     for opt in optimizers:
         opt.step()
     model.zero_grad(set_to_none=True)
 
-    # Periodic CUDA cache clearing to prevent memory fragmentation
-    if step % 10 == 0 and device_type == "cuda":
-        torch.cuda.empty_cache()
+    # 不再周期性调用 torch.cuda.empty_cache()：它会同步整个 device 并逐块
+    # cudaFree，每次可达几十 ms；碎片问题已由 expandable_segments:True 缓解
+
+    if ddp:
+        last_step_handle.wait()
+        # local_last_step 是粘性的，本步没赶上归约的信号下一步必然带上，不会丢
+        last_step = bool(last_step_tensor.item())
+    else:
+        last_step = local_last_step
 
     synchronize()
     t1 = time.time()
@@ -300,8 +433,9 @@ while True:
     step += 1
 
     # logging
-    smooth_train_loss = ema_beta * smooth_train_loss + (1 - ema_beta) * train_loss.item()
-    debiased_smooth_loss = smooth_train_loss / (1 - ema_beta**(step + 1))
+    # EMA 在 GPU 上累积，避免每步 .item() 触发一次 cudaStreamSynchronize；
+    # 只在每 10 步的日志点拉回 CPU
+    smooth_train_loss.mul_(ema_beta).add_(train_loss, alpha=1 - ema_beta)
     pct_done = 100 * progress
     tok_per_sec = int(world_tokens_per_fwdbwd / dt)
     flops_per_sec = num_flops_per_token * total_batch_size / dt
@@ -310,8 +444,9 @@ while True:
     mfu = 100 * flops_per_sec / promised_flops_per_sec_t4
     if step > 10:
         total_training_time += dt
-    print0(f"step {step:05d} ({pct_done:.2f}%) | loss: {debiased_smooth_loss:.6f} | lrm: {lrm:.2f} | dt: {dt * 1000:.2f}ms | tok/sec: {tok_per_sec:,} | mfu: {mfu:.2f} | total time: {total_training_time/60:.2f}m")
     if step % 10 == 0:
+        debiased_smooth_loss = smooth_train_loss.item() / (1 - ema_beta**(step + 1))
+        print0(f"step {step:05d} ({pct_done:.2f}%) | loss: {debiased_smooth_loss:.6f} | lrm: {lrm:.2f} | dt: {dt * 1000:.2f}ms | tok/sec: {tok_per_sec:,} | mfu: {mfu:.2f} | total time: {total_training_time/60:.2f}m")
         wandb_run.log({
             "step": step,
             "total_training_flops": flops_so_far,
@@ -321,7 +456,7 @@ while True:
             "train/dt": dt,
             "train/tok_per_sec": tok_per_sec,
             "train/mfu": mfu,
-        })
+        }) # wandb.log 本身是异步的；commit=False 不是攒批而是同键覆盖，会丢行
 
 # print final stats
 print0(f"Peak memory usage: {get_max_memory() / 1024 / 1024:.2f}MiB")
@@ -4,8 +4,10 @@ https://huggingface.co/datasets/allenai/ai2_arc
 """
 
 from pathlib import Path
+import numpy as np
+import pyarrow.parquet as pq
 from datasets import load_dataset, Dataset
-from tasks.common import Task, render_mc
+from tasks.common import Task, render_mc, rank0_first, load_permutation, bulk_load_env, TASK_DEBUG
 
 class ARC(Task):
 
@@ -20,31 +22,75 @@ class ARC(Task):
 
         # 尝试从本地 parquet 文件加载
         data_path = Path(data_dir) / "arc" / f"{subset}_{split}.parquet"
-        if data_path.exists():
-            self.ds = Dataset.from_parquet(str(data_path))
-        else:
+        def _load_ds():
+            if data_path.exists():
+                # memory_map=True 让字符串 buffer 留在 mmap 页里，零拷贝按需换入，
+                # 而不是 Dataset.from_parquet 那样整表物化进进程内存
+                table = pq.read_table(str(data_path), memory_map=True, use_threads=True)
+                return Dataset(arrow_table=table)
             # 回退到从 HuggingFace 加载
             print(f"Warning: Local dataset not found at {data_path}, loading from HuggingFace...")
-            self.ds = load_dataset("allenai/ai2_arc", name=subset, split=split)
+            return load_dataset("allenai/ai2_arc", name=subset, split=split)
+        # rank 0 先加载暖页/暖缓存，其余 rank 过 barrier 后共享；
+        # bulk_load_env 钉住 Arrow 线程池并在批量物化期间暂停分代 GC
+        with bulk_load_env():
+            self.ds = rank0_first(_load_ds)
+
+            # 一次向量化解码把需要的列取成原生 Python list（ARC 每个 split 不到 8K 行），
+            # get_example 只做 list 下标访问，不再每次物化一整行 Arrow 嵌套结构
+            self._questions = self.ds["question"]
+            self._choices = self.ds["choices"] # list of {"text": [...], "label": [...]}
+            self._answer_keys = self.ds["answerKey"]
+            self._num = len(self._questions)
+            del self.ds # 列已物化，Arrow 表不再需要
+
+        # 扫一遍选项标签：如果全部是标准 A/B/C/D，get_example 用特化的
+        # 单条 f-string 渲染（输出与 render_mc 完全一致），跳过通用路径的
+        # zip/join/列表推导；ARC 偶有数字标签或非四选项的行则整体走通用路径
+        self._fast_render = all(c["label"] == ["A", "B", "C", "D"] for c in self._choices)
 
-        self.ds = self.ds.shuffle(seed=42)
+        # shuffle 用索引置换实现：datasets 的 .shuffle() 会物化一份 indices mapping
+        # （大 split 还会重写一份缓存文件到磁盘），这里只需要一个 numpy 置换数组
+        # （首次生成后缓存到磁盘，热启动 mmap 复用），取行时多一次下标间接寻址即可
+        self._perm_key = (data_dir, f"arc_{subset}", split)
+        self._perm = load_permutation(*self._perm_key, self._num)
+        # 渲染后的 conversation 按（置换后）下标缓存：categorical 评估会对同一个
+        # index 取多次（逐字母打分），render_mc 和 dict 构造是行的纯函数，算一次够了
+        self._cache = [None] * self._num
+
+    def set_epoch(self, epoch):
+        """按 epoch 重建置换，保持各 worker 间确定性"""
+        self._perm = load_permutation(*self._perm_key, self._num, seed=42 + epoch)
+        self._cache = [None] * self._num # 置换变了，缓存的下标含义随之失效
 
     @property
     def eval_type(self):
         return 'categorical'
 
     def num_examples(self):
-        return len(self.ds)
+        return self._num
 
     def get_example(self, index):
-        row = self.ds[index]
-        question = row["question"] # the question text
-        choices = row["choices"]["text"] # the text of each choice
-        answer_string = row["answerKey"] # e.g. "A", "B", "C", "D"
-        letters = row["choices"]["label"] # e.g. ["A", "B", "C", "D"]
-        assert answer_string in letters, f"ARC answer {answer_string} must be one of {letters}" # sanity check
+        cached = self._cache[index]
+        if cached is not None:
+            return cached
+        physical = int(self._perm[index])
+        question = self._questions[physical] # the question text
+        choices = self._choices[physical]["text"] # the text of each choice
+        answer_string = self._answer_keys[physical] # e.g. "A", "B", "C", "D"
+        letters = self._choices[physical]["label"] # e.g. ["A", "B", "C", "D"]
+        if TASK_DEBUG:
+            assert answer_string in letters, f"ARC answer {answer_string} must be one of {letters}" # sanity check
         # create and return the Conversation object
-        user_message = render_mc(question, letters, choices)
+        if self._fast_render:
+            # 形状已知（四个 A/B/C/D 选项）的特化模板，与 render_mc 输出逐字符相同
+            user_message = (
+                f"Multiple Choice question: {question}\n"
+                f"- {choices[0]}=A\n- {choices[1]}=B\n- {choices[2]}=C\n- {choices[3]}=D\n"
+                "\nRespond only with the letter of the correct answer."
+            )
+        else:
+            user_message = render_mc(question, letters, choices)
         messages = [
             {"role": "user", "content": user_message},
             {"role": "assistant", "content": answer_string}
@@ -53,11 +99,13 @@ class ARC(Task):
             "messages": messages,
             "letters": letters, # useful during evaluation, so we can narrow and clamp the assistant prediction to one of the letters
         }
+        self._cache[index] = conversation
         return conversation
 
     def evaluate(self, conversation, assistant_response):
         # the assert here is not strictly speaking needed, but currently the way we eval, we expect this to be true
-        # I'm going to leave the assert here to prevent footguns, but possibly in the future can remove it.
-        assert assistant_response in conversation['letters'], f"ARC answer {assistant_response} is expected to be one of {conversation['letters']}"
+        # gated behind TASK_DEBUG (ZCHAT_TASK_DEBUG=1) to keep it out of the hot eval loop by default
+        if TASK_DEBUG:
+            assert assistant_response in conversation['letters'], f"ARC answer {assistant_response} is expected to be one of {conversation['letters']}"
         assistant_message = conversation['messages'][-1]['content'] # e.g. "A"
         return assistant_response == assistant_message
@@ -6,13 +6,19 @@ We use the "smol" version, which is more appropriate for smaller models.
 
 import os
 from pathlib import Path
+import numpy as np
+import pyarrow.dataset as pads
+import pyarrow.parquet as pq
 from datasets import load_dataset, Dataset
-from tasks.common import Task
+from tasks.common import Task, rank0_first, load_permutation, bulk_load_env, TASK_DEBUG
 
 class SmolTalk(Task):
     """ smol-smoltalk dataset. train is 460K rows, test is 24K rows. """
 
-    def __init__(self, split, data_dir=None, **kwargs):
+    # 预期的角色交替序列，切片比较一次搞定，代替每条 message 一轮 Python 循环
+    _ROLES = ("user", "assistant") * 64
+
+    def __init__(self, split, data_dir=None, preload=True, streaming=False, **kwargs):
         super().__init__(**kwargs)
         assert split in ["train", "test"], "SmolTalk split must be train|test"
 
@@ -22,38 +28,103 @@ class SmolTalk(Task):
 
         # 尝试从本地 parquet 文件加载
         data_path = Path(data_dir) / "smoltalk" / f"{split}.parquet"
-        if data_path.exists():
-            self.ds = Dataset.from_parquet(str(data_path))
-        else:
+        self.streaming = streaming
+        if streaming:
+            # 流式模式：不加载任何数据，按 row group 顺序迭代（见 __iter__），
+            # 峰值内存从 O(dataset) 降到 O(batch)；行数只读 parquet footer 元数据
+            assert data_path.exists(), f"streaming=True requires a local parquet at {data_path}"
+            self._data_path = str(data_path)
+            self.length = pq.ParquetFile(self._data_path).metadata.num_rows
+            self.ds = None
+            self._messages = None
+            self._perm = None
+            return
+        def _load_ds():
+            if data_path.exists():
+                # memory_map=True 让字符串 buffer 留在 mmap 页里，零拷贝按需换入，
+                # train split（460K 行对话）不再整表物化进进程内存；
+                # use_threads 让 parquet 解码在 row group 间并行，
+                # 只取 messages 列，其余列连解码都省掉
+                table = pq.read_table(str(data_path), columns=["messages"], memory_map=True, use_threads=True)
+                return Dataset(arrow_table=table)
             # 回退到从 HuggingFace 加载
             print(f"Warning: Local dataset not found at {data_path}, loading from HuggingFace...")
-            self.ds = load_dataset("HuggingFaceTB/smol-smoltalk", split=split)
+            return load_dataset("HuggingFaceTB/smol-smoltalk", split=split)
+        # rank 0 先加载暖页/暖缓存，其余 rank 过 barrier 后共享；
+        # bulk_load_env 钉住 Arrow 线程池并在批量物化期间暂停分代 GC
+        with bulk_load_env():
+            self.ds = rank0_first(_load_ds)
 
-        self.ds = self.ds.shuffle(seed=42)
+            # preload=True（默认）一次向量化解码把 messages 列取成原生 Python list，
+            # get_example 退化为 list 下标访问；Arrow 行物化（嵌套 struct 逐行解码）
+            # 是数据受限训练里的单样本热点。在意 RSS 的调用方可以传 preload=False
+            if preload:
+                self._messages = self.ds["messages"]
+                self._messages_col = None
+            else:
+                # 非预载路径直接持有 Arrow ChunkedArray：ds[index] 底层是
+                # Table.take([index])，每次都分配一个新 Arrow 数组；改成定位 chunk
+                # 再做 chunk 内下标访问，单行取值零分配，且只解码 messages 一列
+                self._messages = None
+                self._messages_col = self.ds.data.table.column("messages")
+                self._chunk_offsets = np.cumsum([len(c) for c in self._messages_col.chunks])
+
+        # shuffle 用索引置换实现：.shuffle() 对 460K 行的 train split 会物化
+        # indices mapping 并重写一份缓存到磁盘，索引置换只占一个 int64 数组
+        # （首次生成后缓存到磁盘，热启动 mmap 复用）
         self.length = len(self.ds)
+        self._perm_key = (data_dir, "smoltalk", split)
+        self._perm = load_permutation(*self._perm_key, self.length)
+
+    def set_epoch(self, epoch):
+        """按 epoch 重建置换，保持各 worker 间确定性"""
+        self._perm = load_permutation(*self._perm_key, self.length, seed=42 + epoch)
 
     def num_examples(self):
         return self.length
 
+    def __iter__(self):
+        if not self.streaming:
+            # 非流式沿用 Task 的随机访问语义
+            for i in range(len(self)):
+                yield self[i]
+            return
+        # 流式：Scanner 一次解码一个 batch，解码线程化，迭代顺序即文件顺序
+        scanner = pads.dataset(self._data_path, format="parquet").scanner(
+            columns=["messages"], batch_size=4096, use_threads=True)
+        for batch in scanner.to_batches():
+            for row in batch.to_pylist():
+                yield self._make_conversation(row["messages"])
+
     def get_example(self, index):
-        row = self.ds[index]
-        messages = row["messages"]
-        # ---------------------------------------------------------------------
-        # sanity checking asserts here
-        # TODO: we could remove these asserts later, for now just don't want any footguns
-        # there is an optional system message at the beginning
-        assert len(messages) >= 1
-        first_message = messages[0]
-        if first_message["role"] == "system":
-            rest_messages = messages[1:] # optional system message is OK
+        assert not self.streaming, "random access is not available with streaming=True, iterate instead"
+        physical = int(self._perm[index])
+        if self._messages is not None:
+            messages = self._messages[physical]
         else:
-            rest_messages = messages
-        assert len(rest_messages) >= 2, "SmolTalk messages must have at least 2 messages"
-        for i, message in enumerate(rest_messages):
+            # 定位所在 chunk，chunk 内切出单个元素再转 Python，避开 Table.take
+            chunk_idx = int(np.searchsorted(self._chunk_offsets, physical, side="right"))
+            local = physical - (self._chunk_offsets[chunk_idx - 1] if chunk_idx else 0)
+            messages = self._messages_col.chunk(chunk_idx)[int(local)].as_py()
+        return self._make_conversation(messages)
+
+    def _make_conversation(self, messages):
+        # ---------------------------------------------------------------------
+        # sanity checking asserts here, gated behind ZCHAT_TASK_DEBUG=1
+        # (默认关闭：数据已在下载阶段检查过，不必每次取样都重验)
+        if TASK_DEBUG:
+            # there is an optional system message at the beginning
+            assert len(messages) >= 1
+            first_message = messages[0]
+            if first_message["role"] == "system":
+                rest_messages = messages[1:] # optional system message is OK
+            else:
+                rest_messages = messages
+            assert len(rest_messages) >= 2, "SmolTalk messages must have at least 2 messages"
             # user and assistant alternate as user,assistant,user,assistant,...
-            expected_role = "user" if i % 2 == 0 else "assistant"
-            assert message["role"] == expected_role, f"Message {i} has role {message['role']} but should be {expected_role}"
-            assert isinstance(message["content"], str), "Content must be a string"
+            roles = tuple(m["role"] for m in rest_messages)
+            assert roles == self._ROLES[:len(roles)], f"Roles must alternate user/assistant, got {roles}"
+            assert all(type(m["content"]) is str for m in rest_messages), "Content must be a string"
         # ---------------------------------------------------------------------
         # create and return the Conversation object (ok to emit the system message too)
         conversation = {